@@ -16,29 +16,148 @@ Raspberry Piカメラストリーミングプログラム
 必要なライブラリ:
 - Flask: Webアプリケーションフレームワーク
 - Picamera2: Raspberry Piカメラ用ライブラリ
-- PIL (Pillow): 画像処理ライブラリ
-- OpenCV: コンピュータビジョンライブラリ（バックアップ用）
+- OpenCV: コンピュータビジョンライブラリ（エラー画像生成用）
+- NumPy: 数値計算ライブラリ（エラー画像生成用）
 
 作成者: yutapi3
 作成日: 20250407
 """
-from flask import Flask, Response, render_template
+from flask import Flask, Response, render_template, request, send_from_directory
 import time
 import io
 import threading
 import os
-import picamera2  # Picamera2ライブラリをインポート
+import collections
+import socket
 import cv2  # OpenCVライブラリをインポート（エラー画像生成用）
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont  # 画像処理用ライブラリ
+from shared_frames import SharedFrameRing  # プロセス間でフレームを共有するためのリングバッファ
+
+# Picamera2関連ライブラリのインポート（インストールされていない環境でも起動できるようにする）
+try:
+    from picamera2 import Picamera2
+    from picamera2.encoders import JpegEncoder, MJPEGEncoder
+    from picamera2.outputs import FileOutput
+    from libcamera import controls
+    HAS_PICAMERA2 = True
+except ImportError:
+    HAS_PICAMERA2 = False
 
 # Flaskアプリケーションの初期化
 app = Flask(__name__)
 
+# MJPEGストリームの各フレームの前後に付与する固定データ
+FRAME_PREFIX = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n'
+FRAME_SUFFIX = b'\r\n'
+
+# 新しいフレームを待つ間隔（秒）。この間隔ごとにカメラキャプチャスレッドの終了を確認し、
+# 終了していた場合はエラー画像を送ってストリームを終了する
+FRAME_TIMEOUT = 2.0
+
+# メインページをブラウザにキャッシュさせる秒数
+INDEX_CACHE_MAX_AGE = 3600
+
+# ソケットへ直接送信する場合に使用するレスポンスヘッダ
+RAW_RESPONSE_HEADER = (b'HTTP/1.1 200 OK\r\n'
+                       b'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                       b'Cache-Control: no-cache\r\n'
+                       b'Connection: close\r\n\r\n')
+
+# ハードウェアMJPEGエンコーダ(V4L2)のデバイスファイル
+HW_ENCODER_DEVICE = '/dev/video11'
+
+# 設定値（環境変数で上書き可能）
+BUFFER_COUNT = int(os.environ.get("PICAM_BUFFER_COUNT", "6"))  # カメラのフレームバッファ数（picamera2の既定値と同じ6）
+JPEG_QUALITY = int(os.environ.get("PICAM_JPEG_Q", "85"))  # ソフトウェアJPEGエンコーダの品質 (1-100)
+MJPEG_BITRATE = int(os.environ.get("PICAM_MJPEG_BITRATE", "8000000"))  # ハードウェアMJPEGエンコーダのビットレート (bps)
+SHM_NAME = os.environ.get("PICAM_SHM_NAME", "")  # フレームを公開する共有メモリの名前（空の場合は公開しない）
+SHM_SLOTS = int(os.environ.get("PICAM_SHM_SLOTS", "4"))  # 共有メモリのスロット数
+RAW_SOCKET = os.environ.get("PICAM_RAW_SOCKET", "0") == "1"  # ソケットへ直接sendmsg()で送信するかどうか
+
+# カメラのフレームレート
+# フレームの送信間隔はカメラ側のフレーム間隔で決まり、スリープでは調整しない
+# (picamera2のビデオ設定の既定値と同じ30fpsを、設定値として明示しているもの)
+FRAME_RATE = 30
+FRAME_DURATION_US = 1000000 // FRAME_RATE  # 1フレームあたりの時間（マイクロ秒）
+
 # グローバル変数
-frame_buffer = None  # カメラからのフレームを保存するバッファ
-buffer_lock = threading.Lock()  # マルチスレッドでのバッファアクセスを同期するためのロック
+# 最新のフレームを保持するリングバッファ（古いものから破棄）
+# フレームは変更されないbytesオブジェクトで、deque.append()と[-1]の参照はGILにより
+# アトミックに行われるため、読み書きにロックは使用しません
+frames = collections.deque(maxlen=3)
 stop_thread = False  # スレッド停止用フラグ
+shared_ring = None  # 他のプロセスにフレームを公開する共有メモリ上のリングバッファ
+camera_thread = None  # カメラキャプチャスレッド
+camera_thread_lock = threading.Lock()  # カメラキャプチャスレッドの多重起動を防ぐためのロック
+
+class CameraEvent:
+    """
+    クライアントごとの同期イベントを管理するクラス
+    
+    ストリーミング中の各クライアント（スレッド）ごとにイベントを作成し、
+    新しいフレームが届くたびに全クライアントのイベントをセットします。
+    これにより、クライアントが同じフレームを二度受け取ることはなく、
+    受信が追いつかないクライアントは途中のフレームを読み飛ばします。
+    """
+    # 無応答と判断してイベントを破棄するまでの秒数
+    STALE_TIMEOUT = 5.0
+    
+    def __init__(self):
+        self.events = {}  # スレッドID -> [Event, 最後にセットした時刻]
+        self.lock = threading.Lock()  # eventsの追加・削除を同期するためのロック
+    
+    def wait(self, timeout=None):
+        """
+        呼び出し元クライアントのイベントがセットされるまで待機する
+        
+        引数:
+            timeout: 最大待機秒数（Noneの場合は無制限）
+        
+        戻り値:
+            bool: 新しいフレームが届いた場合はTrue、タイムアウトした場合はFalse
+        """
+        ident = threading.get_ident()
+        with self.lock:
+            if ident not in self.events:
+                # 新しいクライアントのイベントを登録
+                self.events[ident] = [threading.Event(), time.time()]
+            event = self.events[ident][0]
+        return event.wait(timeout)
+    
+    def set(self):
+        """
+        全クライアントのイベントをセットする（フレーム到着時に呼び出す）
+        
+        前回セットしたイベントが5秒以上クリアされていない場合は、
+        クライアントが切断されたとみなしてイベントを破棄します。
+        """
+        now = time.time()
+        with self.lock:
+            for ident, entry in list(self.events.items()):
+                event, last_set = entry
+                if not event.is_set():
+                    event.set()
+                    entry[1] = now
+                elif now - last_set > self.STALE_TIMEOUT:
+                    del self.events[ident]
+    
+    def clear(self):
+        """
+        呼び出し元クライアントのイベントをクリアする（フレーム送信後に呼び出す）
+        """
+        with self.lock:
+            entry = self.events.get(threading.get_ident())
+        if entry is not None:
+            entry[0].clear()
+    
+    def remove(self):
+        """
+        呼び出し元クライアントのイベントを破棄する（クライアント切断時に呼び出す）
+        """
+        with self.lock:
+            self.events.pop(threading.get_ident(), None)
+
+frame_event = CameraEvent()  # 新しいフレームの到着をクライアントに通知するイベント
 
 def setup_camera():
     """
@@ -46,7 +165,7 @@ def setup_camera():
     
     この関数は以下の処理を行います:
     1. Picamera2ライブラリを初期化
-    2. カメラの解像度とフォーマット設定
+    2. カメラの解像度、フォーマット、フレームレート設定
     3. 自動フォーカス設定（サポートされている場合）
     
     戻り値:
@@ -54,20 +173,18 @@ def setup_camera():
         None: 初期化に失敗した場合
     """
     try:
-        # 必要なモジュールをインポート
-        from picamera2 import Picamera2
-        from libcamera import controls
-        
         # Picamera2オブジェクトの初期化
         picam2 = Picamera2()
         
         # ビデオ設定を作成
-        # main: 高解像度ストリーム (640x480, RGB888形式)
-        # lores: 低解像度ストリーム (320x240, YUV420形式) - 表示用
+        # main: JPEGエンコード対象のストリーム (640x480, ハードウェアエンコーダが直接扱えるYUV420形式)
+        # buffer_count: カメラのバッファ数（既定値6。エンコード中のバッファがあっても次のフレームを受け取れる数を確保）
+        # FrameDurationLimits: フレーム間隔の最小値と最大値（create_video_configuration()の
+        #                      既定値と同じ30fpsを明示的に指定）
         config = picam2.create_video_configuration(
-            main={"size": (640, 480), "format": "RGB888"},
-            lores={"size": (320, 240), "format": "YUV420"},
-            display="lores"
+            main={"size": (640, 480), "format": "YUV420"},
+            buffer_count=BUFFER_COUNT,
+            controls={"FrameDurationLimits": (FRAME_DURATION_US, FRAME_DURATION_US)}
         )
         picam2.configure(config)
         
@@ -83,134 +200,530 @@ def setup_camera():
         print(f"Picamera2の初期化中にエラーが発生しました: {e}")
         return None
 
+def has_hardware_encoder():
+    """
+    ハードウェアMJPEGエンコーダ(V4L2)が利用可能かどうかを確認する関数
+    
+    戻り値:
+        bool: エンコーダのデバイスファイルが存在する場合はTrue（Raspberry Pi 5などではFalse）
+    """
+    return os.path.exists(HW_ENCODER_DEVICE)
+
+def create_encoder(hardware):
+    """
+    MJPEGストリーム用のエンコーダを作成する関数
+    
+    引数:
+        hardware: Trueの場合はVideoCoreのハードウェアMJPEGエンコーダ、
+                  Falseの場合はソフトウェアのJpegEncoderを作成
+    
+    戻り値:
+        Encoderオブジェクト: MJPEGEncoderまたはJpegEncoder
+    """
+    if hardware:
+        return MJPEGEncoder(bitrate=MJPEG_BITRATE)
+    return JpegEncoder(q=JPEG_QUALITY)
+
+def start_encoding(picam2):
+    """
+    エンコーダを起動し、FrameOutputへのフレーム出力を開始する関数
+    
+    ハードウェアMJPEGエンコーダを優先して使用します。エンコーダのデバイスは
+    start_recording()の中で開かれるため、デバイスが存在しない場合や
+    起動に失敗した場合はソフトウェアのJpegEncoderで起動し直します。
+    
+    引数:
+        picam2: セットアップ済みのPicamera2オブジェクト
+    
+    戻り値:
+        bool: ハードウェアエンコーダで起動した場合はTrue、ソフトウェアエンコーダの場合はFalse
+    
+    例外:
+        Exception: ソフトウェアエンコーダでも起動できなかった場合
+    """
+    if has_hardware_encoder():
+        try:
+            picam2.start_recording(create_encoder(True), FileOutput(FrameOutput()))
+            print("ハードウェアMJPEGエンコーダを使用します")
+            return True
+        except Exception as e:
+            print(f"ハードウェアMJPEGエンコーダを起動できません: {e}")
+            print("ソフトウェアJPEGエンコーダに切り替えます")
+            # 途中まで起動したエンコーダとカメラを停止してから起動し直す
+            try:
+                picam2.stop_recording()
+            except Exception:
+                pass
+            # ソフトウェアエンコーダのワーカーが全コアを通常の優先度で使えるよう、
+            # CPUコアの固定と優先度を元に戻す
+            reset_capture_thread_affinity()
+            reset_capture_thread_priority()
+    else:
+        print("ハードウェアMJPEGエンコーダが見つからないため、ソフトウェアJPEGエンコーダを使用します")
+    
+    picam2.start_recording(create_encoder(False), FileOutput(FrameOutput()))
+    return False
+
+class FrameOutput(io.BufferedIOBase):
+    """
+    エンコーダからのJPEGフレームをリングバッファに書き込む出力先クラス
+    
+    picamera2のFileOutputから1フレームごとにwrite()が呼び出されるため、
+    受け取ったJPEGデータをframesに追加し、
+    待機中の全クライアントに新しいフレームの到着を通知します。
+    """
+    def write(self, buf):
+        """
+        エンコード済みのJPEGフレームをバッファに保存する
+        
+        引数:
+            buf: エンコーダから渡された1フレーム分のJPEGデータ
+        
+        戻り値:
+            int: 書き込んだバイト数
+        """
+        # エンコーダがbytesを渡してきた場合はそのまま共有し、余計なコピーを作らない
+        # (memoryviewなど再利用されるバッファの場合のみ、1回だけコピーする)
+        # コピーはロックの外で行い、クライアントを待たせないようにする
+        frame = buf if isinstance(buf, bytes) else bytes(buf)
+        
+        # バッファへ最新フレームを追加（アトミックな操作のためロック不要）
+        frames.append(frame)
+        
+        # 待機中のクライアントを起こす
+        frame_event.set()
+        
+        # 他のプロセス向けに共有メモリにも書き込む（有効な場合のみ）
+        # 共有メモリへの書き込みに失敗してもストリーミングには影響させない
+        if shared_ring is not None:
+            try:
+                if not shared_ring.write(frame):
+                    print(f"フレームが共有メモリのスロットサイズを超えたため破棄しました: {len(frame)} バイト")
+            except Exception as e:
+                print(f"共有メモリへの書き込み中にエラーが発生しました: {e}")
+        return len(frame)
+
+def is_dedicated_os_thread():
+    """
+    呼び出し元がメインスレッドとは別のOSスレッドで実行されているかを確認する関数
+    
+    geventなどでスレッドがメインスレッド上のグリーンレットとして実行されている場合、
+    スレッド単位の設定がプロセス全体に影響するため、その判定に使用します。
+    
+    戻り値:
+        bool: 専用のOSスレッドで実行されている場合はTrue、そうでない場合はFalse
+    """
+    get_native_id = getattr(threading, "get_native_id", None)
+    return get_native_id is not None and get_native_id() != os.getpid()
+
+def pin_capture_thread():
+    """
+    カメラキャプチャスレッドを専用のCPUコアに固定する関数
+    
+    マルチコアのRaspberry Piで最後のコアをキャプチャ処理専用とし、
+    コア間の移動によるキャッシュミスを防いでフレーム間隔を安定させます。
+    残りのコアはFlask/WSGIのリクエスト処理に使用されます。
+    この後に作成されるPicamera2/libcameraやエンコーダのスレッドもすべて同じコアに
+    固定されるため、エンコードをVideoCoreで行うハードウェアエンコーダ使用時のみ
+    呼び出してください（ソフトウェアエンコーダのワーカーが1コアに制限されるため）。
+    """
+    # メインスレッド上で実行されている場合（geventなど）はプロセス全体が固定されるため何もしない
+    if not is_dedicated_os_thread():
+        return
+    
+    cpu_count = os.cpu_count() or 1
+    if cpu_count < 2:
+        return
+    
+    try:
+        os.sched_setaffinity(0, {cpu_count - 1})
+        print(f"カメラキャプチャスレッドをCPU {cpu_count - 1} に固定しました")
+    except (AttributeError, OSError) as e:
+        print(f"CPUアフィニティの設定に失敗しました: {e}")
+
+def reset_capture_thread_affinity():
+    """
+    pin_capture_thread()で固定したCPUコアを元に戻す関数
+    
+    ハードウェアエンコーダの起動に失敗してソフトウェアエンコーダに切り替える場合に、
+    エンコーダのワーカースレッドを作成する前に呼び出します。
+    """
+    if not is_dedicated_os_thread():
+        return
+    
+    try:
+        # メインスレッド（プロセス起動時）のCPUアフィニティに戻す
+        os.sched_setaffinity(0, os.sched_getaffinity(os.getpid()))
+    except (AttributeError, OSError) as e:
+        print(f"CPUアフィニティの復元に失敗しました: {e}")
+
+def raise_capture_thread_priority():
+    """
+    カメラキャプチャスレッドの優先度を上げる関数
+    
+    Flaskのリクエスト処理で負荷が高い場合でもキャプチャ処理が後回しにされないよう、
+    リアルタイムスケジューリング(SCHED_RR)を設定します。権限がない場合は
+    nice値を下げ、それも失敗した場合は通常の優先度のまま実行します。
+    この後に作成されるPicamera2/libcameraやエンコーダのスレッドもすべて同じ優先度を
+    引き継ぐため、CPU負荷の高いソフトウェアエンコーダのワーカーがFlaskを圧迫しないよう、
+    ハードウェアエンコーダ使用時のみ呼び出してください。
+    """
+    # メインスレッド上で実行されている場合（geventなど）はプロセス全体に影響するため何もしない
+    if not is_dedicated_os_thread():
+        return
+    
+    try:
+        os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(10))
+        print("カメラキャプチャスレッドにSCHED_RRを設定しました")
+        return
+    except (AttributeError, OSError):
+        pass
+    
+    try:
+        os.nice(-5)
+        print("カメラキャプチャスレッドのnice値を下げました")
+    except (AttributeError, OSError):
+        print("カメラキャプチャスレッドの優先度を変更できませんでした（権限がありません）")
+
+def reset_capture_thread_priority():
+    """
+    raise_capture_thread_priority()で上げた優先度を元に戻す関数
+    
+    ハードウェアエンコーダの起動に失敗してソフトウェアエンコーダに切り替える場合に、
+    エンコーダのワーカースレッドを作成する前に呼び出します。
+    """
+    if not is_dedicated_os_thread():
+        return
+    
+    try:
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+    except (AttributeError, OSError):
+        pass
+    
+    try:
+        # メインスレッド（プロセス起動時）のnice値に戻す
+        os.setpriority(os.PRIO_PROCESS, 0, os.getpriority(os.PRIO_PROCESS, os.getpid()))
+    except (AttributeError, OSError) as e:
+        print(f"カメラキャプチャスレッドの優先度の復元に失敗しました: {e}")
+
 def capture_frames():
     """
     カメラからフレームを継続的にキャプチャし、グローバルバッファに保存するスレッド関数
     
     このスレッド関数は以下の処理を行います:
-    1. Picamera2ライブラリの確認とインポート
-    2. カメラのセットアップと起動
-    3. 連続的なフレームのキャプチャ（JPEG形式）
-    4. バッファへの保存（スレッドセーフな方法で）
+    1. Picamera2ライブラリの確認
+    2. キャプチャスレッドのCPUコア固定と優先度設定（ハードウェアエンコーダ使用時）、
+       カメラのセットアップと起動
+    3. MJPEGEncoder（またはJpegEncoder）による連続的なフレームのエンコード（JPEG形式）
+    4. FrameOutputを介したバッファへの保存（スレッドセーフな方法で）
     5. エラー処理とクリーンアップ
     
     グローバル変数:
-        frame_buffer: キャプチャしたフレームを保存するバッファ
+        frames: キャプチャしたフレームを保存するリングバッファ
         stop_thread: スレッド停止用のフラグ
     """
-    global frame_buffer, stop_thread
+    global stop_thread, shared_ring
     
     # 必要なライブラリがインストールされているか確認
-    try:
-        from picamera2 import Picamera2
-        from picamera2.encoders import JpegEncoder
-        from picamera2.outputs import FileOutput
-    except ImportError:
+    if not HAS_PICAMERA2:
         print("picamera2がインストールされていません。以下のコマンドでインストールしてください:")
         print("sudo apt install -y python3-picamera2")
         return
     
     print("カメラキャプチャスレッドを開始します...")
     
+    # カメラのセットアップ前にCPUコアと優先度を設定し、Picamera2内部のスレッドにも引き継がせる
+    # (ソフトウェアエンコーダのワーカーを1コアに制限したり、高い優先度で実行したり
+    #  しないよう、どちらもハードウェアエンコーダを使用する場合のみ行う)
+    if has_hardware_encoder():
+        pin_capture_thread()
+        raise_capture_thread_priority()
+    
     # カメラのセットアップ
     picam2 = setup_camera()
     if picam2 is None:
         print("カメラの初期化に失敗しました")
         return
     
+    # 他のプロセスとフレームを共有するための共有メモリを作成（有効な場合のみ）
+    if SHM_NAME:
+        try:
+            shared_ring = SharedFrameRing.create(SHM_NAME, slot_count=SHM_SLOTS)
+            print(f"共有メモリ /dev/shm/{SHM_NAME} にフレームを公開します")
+        except Exception as e:
+            print(f"共有メモリの作成に失敗しました: {e}")
+    
+    recording = False  # エンコーダの起動に成功したかどうか
     try:
-        # カメラを起動
-        picam2.start()
+        # エンコーダを起動し、出力先のフレームバッファへ録画（キャプチャ）を開始
+        # (ハードウェアエンコーダを優先し、使えない場合はソフトウェアエンコーダで起動)
+        start_encoding(picam2)
+        recording = True
         print("カメラの起動に成功しました")
         
-        # JPEGエンコーダを初期化（品質90%）
-        encoder = JpegEncoder(q=90)
-        
-        # メインループ - stop_threadフラグがTrueになるまで実行
+        # メインループ - stop_threadフラグがTrueになるまで待機
+        # フレームはエンコーダのスレッドからFrameOutput.write()経由で届きます
         while not stop_thread:
-            # 一時的なバイトストリームを作成
-            stream = io.BytesIO()
-            
-            # 現在のフレームをJPEG形式でキャプチャし、ストリームに保存
-            picam2.capture_file(stream, format='jpeg')
-            
-            # ストリームの読み取り位置を先頭に戻す
-            stream.seek(0)
-            
-            # スレッドセーフにバッファを更新
-            with buffer_lock:
-                frame_buffer = stream.getvalue()
-            
-            # フレームレートを約30fpsに制限（0.033秒のスリープ）
-            time.sleep(0.033)
+            time.sleep(0.1)
             
     except Exception as e:
         print(f"フレームキャプチャ中にエラーが発生しました: {e}")
     finally:
-        # カメラリソースのクリーンアップ
+        # カメラリソースのクリーンアップ（失敗しても共有メモリの後片付けは続ける）
         if picam2:
-            picam2.close()
+            try:
+                if recording:
+                    picam2.stop_recording()
+                picam2.close()
+            except Exception as e:
+                print(f"カメラの終了処理中にエラーが発生しました: {e}")
+        if shared_ring is not None:
+            ring, shared_ring = shared_ring, None
+            ring.close()
         print("カメラキャプチャスレッドを終了します")
 
+def start_camera_thread():
+    """
+    カメラキャプチャスレッドを起動する関数
+    
+    直接起動した場合とWSGIサーバー(gunicornなど)から読み込まれた場合の
+    どちらからも呼び出されるため、スレッドは一度だけ起動します。
+    
+    戻り値:
+        threading.Thread: カメラキャプチャスレッド
+    """
+    global camera_thread
+    
+    with camera_thread_lock:
+        if camera_thread is None:
+            # カメラキャプチャスレッドを開始（デーモンスレッドとして実行）
+            camera_thread = threading.Thread(target=capture_frames)
+            camera_thread.daemon = True
+            camera_thread.start()
+    return camera_thread
+
+def build_error_jpeg():
+    """
+    カメラに接続できない場合に表示するエラー画像を生成する関数
+    
+    戻り値:
+        bytes: エラーメッセージを描画したJPEG画像データ
+        None: 画像の生成に失敗した場合
+    """
+    try:
+        # 黒い背景画像を作成
+        img = np.zeros((480, 640, 3), dtype=np.uint8)
+        # エラーメッセージを描画（OpenCVの標準フォントは日本語に対応していないため英語で表示）
+        cv2.putText(img, "Camera not available", (100, 240),
+                    cv2.FONT_HERSHEY_SIMPLEX, 1.0, (255, 255, 255), 2)
+        
+        # 画像をJPEG形式のバイトデータに変換
+        ok, buf = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        if not ok:
+            raise RuntimeError("JPEGエンコードに失敗しました")
+        return buf.tobytes()
+    except Exception as e:
+        print(f"エラー画像の生成に失敗しました: {e}")
+        return None
+
+# エラー画像は起動時に一度だけ生成し、全クライアントで使い回す
+CAMERA_ERROR_JPEG = build_error_jpeg()
+
+def is_camera_running():
+    """
+    カメラキャプチャスレッドが動作中かどうかを確認する関数
+    
+    戻り値:
+        bool: スレッドが起動済みで終了していない場合はTrue
+    """
+    return camera_thread is not None and camera_thread.is_alive()
+
+def wait_first_frame():
+    """
+    最初のフレームがバッファに届くまで待機する関数
+    
+    過去にフレームが届いていても、カメラキャプチャスレッドが終了している場合は
+    新しいフレームが届くことはないため、待機せずにFalseを返します。
+    
+    戻り値:
+        bool: フレームが届いていてカメラが動作中の場合はTrue、
+              カメラが停止している場合や10秒経過しても届かない場合はFalse
+    """
+    wait_count = 0
+    while not frames:
+        if not is_camera_running():
+            return False
+        time.sleep(0.5)  # 0.5秒待機
+        wait_count += 1
+        if wait_count > 20:  # 10秒経過してもバッファが初期化されない場合
+            return False
+    return is_camera_running()
+
+def iter_latest_frames():
+    """
+    新しいフレームが届くたびに最新のJPEGフレームを返すジェネレーター関数
+    
+    呼び出し元クライアントのイベントで新しいフレームの到着を待ち、
+    バッファから最新フレームを取得して返します。送信が追いつかないクライアントには
+    途中のフレームを読み飛ばして常に最新のフレームだけを返し、同じフレームを
+    二度返すことはありません。フレームが途切れてもカメラキャプチャスレッドが
+    動作中であれば待機を続け、スレッドが終了した場合のみエラー画像を返して終了します。
+    ジェネレーターが閉じられると
+    クライアントのイベントを破棄するため、同じスレッドでclose()してください。
+    
+    戻り値:
+        generator: 1フレーム分のJPEGデータ(bytes)
+    """
+    # このクライアントに最後に返したフレーム
+    last_frame = None
+    
+    try:
+        while not stop_thread:
+            # このクライアントのイベントがセットされるまで待機
+            if not frame_event.wait(timeout=FRAME_TIMEOUT):
+                # 一時的にフレームが途切れただけの場合は、カメラの復帰を待ち続ける
+                if is_camera_running():
+                    continue
+                # カメラキャプチャスレッドが終了した場合は、エラー画像を送ってストリームを終了する
+                print("カメラが停止したため、ストリームを終了します")
+                if CAMERA_ERROR_JPEG is not None:
+                    yield CAMERA_ERROR_JPEG
+                break
+            frame_event.clear()
+            
+            # バッファから最新フレームの参照を取得（アトミックな操作のためロック不要）
+            # 待機中に複数のフレームが届いていても、途中のフレームは送らずに読み飛ばす
+            frame = frames[-1]
+            
+            # イベントのクリアと取得の間に届いたフレームは既に返しているため、次のフレームを待つ
+            if frame is last_frame:
+                continue
+            last_frame = frame
+            yield frame
+    finally:
+        # 切断したクライアントのイベントを破棄し、以降の通知対象から外す
+        frame_event.remove()
+
 def gen_frames():
     """
     ビデオストリーム用のフレームジェネレーター関数
     
     この関数は以下の処理を行います:
-    1. カメラバッファからフレームを取得
+    1. 新しいフレームの到着を待ち、カメラバッファからフレームを取得
     2. MJPEGストリーム形式に変換
-    3. カメラが利用できない場合のエラー画像生成
+    3. カメラが利用できない場合のエラー画像送信
     
     戻り値:
         generator: multipart/x-mixed-replace形式のMJPEGストリームデータ
     """
-    global frame_buffer
+    # 最初のフレームがバッファに届くまで待機
+    if not wait_first_frame():
+        # 起動時に生成済みのエラー画像をMJPEG形式で返す
+        if CAMERA_ERROR_JPEG is not None:
+            yield b''.join((FRAME_PREFIX, CAMERA_ERROR_JPEG, FRAME_SUFFIX))
+        return
     
-    # フレームバッファが初期化されるまで待機
-    wait_count = 0
-    while frame_buffer is None:
-        time.sleep(0.5)  # 0.5秒待機
-        wait_count += 1
-        if wait_count > 20:  # 10秒経過してもバッファが初期化されない場合
-            # エラーメッセージを含む静的イメージを生成
-            try:
-                # 黒い背景画像を作成
-                img = Image.new('RGB', (640, 480), color=(0, 0, 0))
-                d = ImageDraw.Draw(img)
-                # エラーメッセージを描画
-                d.text((100, 240), "カメラに接続できません", fill=(255, 255, 255))
-                
-                # 画像をJPEG形式のバイトデータに変換
-                img_bytes = io.BytesIO()
-                img.save(img_bytes, format='JPEG')
-                img_bytes = img_bytes.getvalue()
-                
-                # MJPEG形式でエラー画像を返す
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + img_bytes + b'\r\n')
-                return
-            except Exception as e:
-                print(f"エラー画像の生成に失敗しました: {e}")
-                return
-    
-    # メインストリーミングループ - 継続的にフレームを送信
-    while True:
-        # スレッドセーフにバッファからフレームを取得
-        with buffer_lock:
-            if frame_buffer is not None:
-                # MJPEG形式でフレームを返す
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_buffer + b'\r\n')
+    # メインストリーミングループ - 新しいフレームが届くたびに送信
+    latest_frames = iter_latest_frames()
+    try:
+        for frame in latest_frames:
+            # MJPEG形式でフレームを返す
+            # (WSGIサーバーはyieldごとにチャンクを書き込むため、1フレームを1回で返す。
+            #  コピーを伴わない送信はPICAM_RAW_SOCKET=1のsendmsg()経路で行う)
+            yield b''.join((FRAME_PREFIX, frame, FRAME_SUFFIX))
+    finally:
+        # クライアントが切断されると、WSGIサーバーがこのジェネレーターをclose()する
+        # (送信エラー自体はサーバー側のwrite()で発生し、ここには届かない)
+        latest_frames.close()
+
+def get_raw_socket(environ):
+    """
+    WSGIサーバーからクライアントのソケットを取得する関数
+    
+    引数:
+        environ: WSGI環境変数
+    
+    戻り値:
+        socket: gunicornまたはWerkzeugのクライアントソケット
+        None: ソケットを取得できない、またはsendmsg()が使えない場合
+    """
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None or not hasattr(sock, 'sendmsg'):
+        return None
+    return sock
+
+def send_buffers(sock, buffers):
+    """
+    複数のバッファを連結せずにsendmsg()で1回のシステムコールとして送信する関数
+    
+    一部のみ送信された場合は、残りのデータを送信し終えるまで繰り返します。
+    
+    引数:
+        sock: 送信先のソケット
+        buffers: 送信するbytesのリスト
+    """
+    views = [memoryview(buf) for buf in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        # 送信し終えたバッファを取り除き、途中まで送信したバッファは残りを切り出す
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
+
+def stream_to_socket(sock):
+    """
+    クライアントのソケットへ直接MJPEGストリームを送信する関数
+    
+    WSGIのジェネレーターを経由せず、ヘッダ・JPEG本体・末尾をsendmsg()で
+    まとめて送信します。クライアントが切断されるか、カメラが停止するまで戻りません。
+    送信後はソケットを切断し、WSGIサーバーが続けてデータを書き込まないようにします。
+    
+    引数:
+        sock: クライアントのソケット
+    """
+    latest_frames = None
+    try:
+        send_buffers(sock, [RAW_RESPONSE_HEADER])
         
-        # フレームレートを約30fpsに制限
-        time.sleep(0.033)
+        # 最初のフレームがバッファに届くまで待機
+        if not wait_first_frame():
+            if CAMERA_ERROR_JPEG is not None:
+                send_buffers(sock, [FRAME_PREFIX, CAMERA_ERROR_JPEG, FRAME_SUFFIX])
+            return
+        
+        # メインストリーミングループ - 新しいフレームが届くたびに送信
+        latest_frames = iter_latest_frames()
+        for frame in latest_frames:
+            send_buffers(sock, [FRAME_PREFIX, frame, FRAME_SUFFIX])
+    except OSError:
+        # クライアントが切断された場合はフレームの送信を止めて終了する
+        pass
+    finally:
+        if latest_frames is not None:
+            latest_frames.close()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+@app.before_request
+def ensure_camera_thread():
+    """
+    最初のリクエスト時にカメラキャプチャスレッドを起動するフック
+    
+    WSGIサーバーから読み込まれた場合は__main__ブロックが実行されないため、
+    ここでカメラキャプチャスレッドを起動します。
+    """
+    start_camera_thread()
 
 @app.route('/')
 def index():
     """
     メインページを表示するルートハンドラ
     
-    HTML, CSS, JavaScriptを含むWebページを返します。
+    static/index.html (HTML, CSS, JavaScriptを含むWebページ) を返します。
     このページには以下の機能があります:
     - ビデオストリームの表示
     - レスポンシブなデザイン
@@ -218,55 +731,9 @@ def index():
     - ストリーミング状態の表示
     
     戻り値:
-        string: HTMLコンテンツ
-    """
-    html = """
-    <!DOCTYPE html>
-    <html>
-      <head>
-        <title>Raspberry Piカメラストリーミング</title>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <style>
-          body { font-family: Arial, sans-serif; margin: 0; padding: 20px; text-align: center; background-color: #f5f5f5; }
-          h1 { color: #333; }
-          .video-container { margin: 20px auto; max-width: 800px; background-color: #000; padding: 10px; border-radius: 5px; box-shadow: 0 4px 6px rgba(0,0,0,0.1); }
-          img { width: 100%; border: 1px solid #ddd; }
-          .status { color: #666; margin-top: 10px; background-color: #fff; padding: 5px; border-radius: 3px; }
-          .info-panel { margin: 20px 0; text-align: left; background-color: #fff; padding: 15px; border-radius: 5px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
-        </style>
-        <script>
-          // 接続エラーを処理するJavaScript関数
-          function handleImageError() {
-            document.getElementById('status').innerHTML = '<span style="color:red">カメラからの映像を取得できません。5秒後に再試行します...</span>';
-            setTimeout(function() {
-              var img = document.getElementById('stream');
-              img.src = '/video_feed?t=' + new Date().getTime();
-            }, 5000);
-          }
-          
-          // 定期的に接続状態表示を更新するタイマー
-          setInterval(function() {
-            var status = document.getElementById('status');
-            var dotCount = (status.innerText.match(/\./g) || []).length;
-            if (dotCount > 5) {
-              status.innerText = 'カメラストリーミング中';
-            } else {
-              status.innerText = status.innerText + '.';
-            }
-          }, 1000);
-        </script>
-      </head>
-      <body>
-        <h1>Raspberry Piカメラストリーミング</h1>
-        <div class="video-container">
-          <img id="stream" src="/video_feed" alt="カメラストリーム" onerror="handleImageError()">
-        </div>
-        <p id="status" class="status">カメラストリーミング中</p>
-      </body>
-    </html>
-    """
-    return html
+        Response: ブラウザにキャッシュさせるCache-Control付きの静的ファイルレスポンス
+    """
+    return send_from_directory(app.static_folder, 'index.html', max_age=INDEX_CACHE_MAX_AGE)
 
 @app.route('/video_feed')
 def video_feed():
@@ -274,10 +741,18 @@ def video_feed():
     ビデオフィードをストリーミングするルートハンドラ
     
     gen_frames()ジェネレーター関数からのMJPEGストリームを返します。
+    PICAM_RAW_SOCKET=1の場合は、クライアントのソケットへ直接sendmsg()で送信します。
     
     戻り値:
         Response: multipart/x-mixed-replace形式のストリームレスポンス
     """
+    sock = get_raw_socket(request.environ) if RAW_SOCKET else None
+    if sock is not None:
+        # ストリームはソケットへ送信済みのため、空のレスポンスを返す
+        # (ソケットは切断済みのため、WSGIサーバーによる書き込みは破棄されます)
+        stream_to_socket(sock)
+        return Response(status=200)
+    
     return Response(gen_frames(),
                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
@@ -288,15 +763,13 @@ def check_picamera2():
     戻り値:
         bool: picamera2が利用可能な場合はTrue、そうでない場合はFalse
     """
-    try:
-        from picamera2 import Picamera2
-        print(f"picamera2 が正常にインポートされました")
+    if HAS_PICAMERA2:
+        print("picamera2 が正常にインポートされました")
         return True
-    except ImportError:
-        print("picamera2 がインストールされていません")
-        print("以下のコマンドでインストールしてください:")
-        print("sudo apt install -y python3-picamera2")
-        return False
+    print("picamera2 がインストールされていません")
+    print("以下のコマンドでインストールしてください:")
+    print("sudo apt install -y python3-picamera2")
+    return False
 
 if __name__ == '__main__':
     """
@@ -319,10 +792,8 @@ if __name__ == '__main__':
             print(f"OpenCVストリーミングの起動に失敗しました: {e}")
         exit(0)
     
-    # カメラキャプチャスレッドを開始（デーモンスレッドとして実行）
-    camera_thread = threading.Thread(target=capture_frames)
-    camera_thread.daemon = True
-    camera_thread.start()
+    # カメラキャプチャスレッドを開始
+    start_camera_thread()
     
     print("Raspberry Piカメラストリーミングサーバーを起動します...")
     print("ブラウザで http://<IPアドレス>:5000/ にアクセスしてください")
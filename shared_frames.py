@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共有メモリ上のフレームリングバッファ
+
+カメラキャプチャスレッドがエンコードしたJPEGフレームを/dev/shm上の共有メモリに
+書き込み、ストリーミングサーバー以外のプロセス（画像認識、録画など）からも
+同じフレームを読み出せるようにするモジュールです。
+
+共有メモリのレイアウト:
+    ヘッダ (24バイト):
+        [4s マジック "PICM"][u32 スロット数][u32 スロットサイズ][4バイト予約][u64 最新の通し番号]
+    スロット (スロット数分、それぞれ 24バイト + スロットサイズ):
+        [u64 通し番号][f64 タイムスタンプ][u32 データ長][4バイト予約][JPEGデータ...]
+
+書き込み側は通し番号seqのフレームをスロット (seq % スロット数) に書き込み、
+スロットの通し番号、最後にヘッダの最新通し番号の順で更新します。
+読み込み側はコピーの前後でスロットの通し番号を確認し、
+コピー中に上書きされたフレームは読み直します。
+
+使用例（別プロセスからの読み込み）:
+    from shared_frames import SharedFrameRing
+    ring = SharedFrameRing.attach("picam")
+    frame = ring.wait_for_frame(last_seq=0, timeout=2.0)
+    if frame is not None:
+        seq, timestamp, jpeg = frame
+"""
+import struct
+import time
+from multiprocessing import shared_memory
+
+# ヘッダとスロットヘッダの構造
+HEADER = struct.Struct('<4sII4xQ')
+SLOT_HEADER = struct.Struct('<QdI4x')
+MAGIC = b'PICM'
+
+# ヘッダ内の最新通し番号の位置
+LATEST_SEQ = struct.Struct('<Q')
+LATEST_SEQ_OFFSET = HEADER.size - LATEST_SEQ.size
+
+
+class SharedFrameRing:
+    """
+    共有メモリ上のJPEGフレームリングバッファを扱うクラス
+
+    書き込み側はcreate()、読み込み側はattach()でインスタンスを作成します。
+    """
+    def __init__(self, shm, slot_count, slot_size, owner):
+        """
+        引数:
+            shm: SharedMemoryオブジェクト
+            slot_count: スロット数
+            slot_size: 1スロットに格納できるJPEGデータの最大バイト数
+            owner: 共有メモリを作成したプロセスの場合はTrue
+        """
+        self.shm = shm
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.owner = owner
+        self.seq = 0  # 書き込み側が最後に書き込んだ通し番号
+
+    @classmethod
+    def create(cls, name, slot_count=4, slot_size=1024 * 1024):
+        """
+        フレーム書き込み用の共有メモリを作成する
+
+        同じ名前のフレームリングバッファが残っている場合（前回の異常終了など）は
+        削除して作り直します。別の形式の共有メモリや、他のプロセスが書き込み中の
+        フレームリングバッファは削除せず、例外を送出します。
+
+        引数:
+            name: 共有メモリの名前（/dev/shm/<name>として作成されます）
+            slot_count: スロット数
+            slot_size: 1スロットに格納できるJPEGデータの最大バイト数
+
+        戻り値:
+            SharedFrameRing: 書き込み用のインスタンス
+
+        例外:
+            ValueError: スロット数またはスロットサイズが1未満の場合
+            FileExistsError: 同じ名前の共有メモリを削除できない場合
+        """
+        if slot_count < 1:
+            raise ValueError(f"スロット数は1以上を指定してください: {slot_count}")
+        if slot_size < 1:
+            raise ValueError(f"スロットサイズは1以上を指定してください: {slot_size}")
+
+        # 各スロットの先頭を8バイト境界に揃える
+        slot_size = (slot_size + 7) // 8 * 8
+        size = HEADER.size + slot_count * (SLOT_HEADER.size + slot_size)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            cls._remove_stale(name)
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        HEADER.pack_into(shm.buf, 0, MAGIC, slot_count, slot_size, 0)
+        for index in range(slot_count):
+            SLOT_HEADER.pack_into(shm.buf, cls._slot_offset(index, slot_size), 0, 0.0, 0)
+        return cls(shm, slot_count, slot_size, owner=True)
+
+    @staticmethod
+    def _remove_stale(name, check_interval=0.5):
+        """
+        前回の異常終了などで残ったフレームリングバッファを削除する
+
+        引数:
+            name: 共有メモリの名前
+            check_interval: 他のプロセスが書き込み中かどうかを確認するために待つ秒数
+
+        例外:
+            FileExistsError: フレームリングバッファではない場合、または書き込み中の場合
+        """
+        stale = shared_memory.SharedMemory(name=name)
+        try:
+            if stale.size < HEADER.size or bytes(stale.buf[:len(MAGIC)]) != MAGIC:
+                raise FileExistsError(
+                    f"同じ名前の共有メモリがフレームリングバッファ以外の用途で使用されています: {name}")
+
+            # 通し番号が進んでいる場合は、他のプロセスが書き込み中とみなす
+            seq = LATEST_SEQ.unpack_from(stale.buf, LATEST_SEQ_OFFSET)[0]
+            time.sleep(check_interval)
+            if LATEST_SEQ.unpack_from(stale.buf, LATEST_SEQ_OFFSET)[0] != seq:
+                raise FileExistsError(
+                    f"同じ名前のフレームリングバッファに他のプロセスが書き込み中です: {name}")
+        except FileExistsError:
+            stale.close()
+            # 削除しない共有メモリをresource_trackerが終了時に削除しないよう登録を解除
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(stale._name, "shared_memory")
+            except Exception:
+                pass
+            raise
+
+        stale.close()
+        stale.unlink()
+
+    @classmethod
+    def attach(cls, name):
+        """
+        既存の共有メモリにフレーム読み込み用として接続する
+
+        引数:
+            name: 共有メモリの名前
+
+        戻り値:
+            SharedFrameRing: 読み込み用のインスタンス
+
+        例外:
+            FileNotFoundError: 共有メモリが存在しない場合
+            ValueError: 共有メモリの形式が正しくない場合
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        # 読み込み側の終了時にresource_trackerが共有メモリを削除しないよう登録を解除
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+
+        magic, slot_count, slot_size, _ = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            shm.close()
+            raise ValueError(f"フレームリングバッファの共有メモリではありません: {name}")
+        return cls(shm, slot_count, slot_size, owner=False)
+
+    @staticmethod
+    def _slot_offset(index, slot_size):
+        """
+        スロットの先頭位置を返す
+        """
+        return HEADER.size + index * (SLOT_HEADER.size + slot_size)
+
+    def write(self, jpeg):
+        """
+        JPEGフレームを次のスロットに書き込む（書き込み側のみ）
+
+        引数:
+            jpeg: 1フレーム分のJPEGデータ
+
+        戻り値:
+            bool: 書き込んだ場合はTrue、スロットに収まらず破棄した場合はFalse
+        """
+        length = len(jpeg)
+        if length > self.slot_size:
+            return False
+
+        seq = self.seq + 1
+        buf = self.shm.buf
+        offset = self._slot_offset(seq % self.slot_count, self.slot_size)
+
+        # スロットを無効化してからデータを書き込み、最後に通し番号を公開する
+        SLOT_HEADER.pack_into(buf, offset, 0, 0.0, 0)
+        data_offset = offset + SLOT_HEADER.size
+        buf[data_offset:data_offset + length] = jpeg
+        SLOT_HEADER.pack_into(buf, offset, seq, time.time(), length)
+        LATEST_SEQ.pack_into(buf, LATEST_SEQ_OFFSET, seq)
+        self.seq = seq
+        return True
+
+    def latest_seq(self):
+        """
+        最後に書き込まれたフレームの通し番号を返す（フレームがない場合は0）
+        """
+        return LATEST_SEQ.unpack_from(self.shm.buf, LATEST_SEQ_OFFSET)[0]
+
+    def read_latest(self, retries=3):
+        """
+        最新のフレームを読み込む
+
+        引数:
+            retries: コピー中にフレームが上書きされた場合に読み直す回数
+
+        戻り値:
+            tuple: (通し番号, タイムスタンプ, JPEGデータ)
+            None: フレームがまだない場合、または読み込みに失敗した場合
+        """
+        buf = self.shm.buf
+        for _ in range(retries):
+            seq = self.latest_seq()
+            if seq == 0:
+                return None
+
+            offset = self._slot_offset(seq % self.slot_count, self.slot_size)
+            slot_seq, timestamp, length = SLOT_HEADER.unpack_from(buf, offset)
+            if slot_seq != seq:
+                continue
+
+            data_offset = offset + SLOT_HEADER.size
+            jpeg = bytes(buf[data_offset:data_offset + length])
+
+            # コピー中に上書きされていなければ採用する
+            if SLOT_HEADER.unpack_from(buf, offset)[0] == seq:
+                return seq, timestamp, jpeg
+        return None
+
+    def wait_for_frame(self, last_seq, timeout=None, interval=0.005):
+        """
+        last_seqより新しいフレームが書き込まれるまで待機して読み込む
+
+        引数:
+            last_seq: 前回読み込んだフレームの通し番号
+            timeout: 最大待機秒数（Noneの場合は無制限）
+            interval: 通し番号を確認する間隔（秒）
+
+        戻り値:
+            tuple: (通し番号, タイムスタンプ, JPEGデータ)
+            None: タイムアウトした場合
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.latest_seq() > last_seq:
+                frame = self.read_latest()
+                if frame is not None:
+                    return frame
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+
+    def close(self):
+        """
+        共有メモリを閉じる（書き込み側の場合は共有メモリも削除する）
+        """
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
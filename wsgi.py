@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WSGIエントリーポイント
+
+gunicornなどのWSGIサーバーからRaspberry Piカメラストリーミングサーバーを
+起動するためのモジュールです。MJPEGストリームは長時間レスポンスを保持するため、
+Flaskの開発用サーバーではなく、geventワーカーで多数のクライアントを
+協調的に処理します。
+
+起動方法:
+    gunicorn -k gevent -w 1 -b 0.0.0.0:5000 wsgi:app
+
+注意:
+    カメラは1つのプロセスからしか開けないため、ワーカー数(-w)は必ず1にしてください。
+    カメラキャプチャスレッドは最初のリクエスト時に起動されます。
+"""
+from picamera_stream import app
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)